@@ -1,8 +1,19 @@
+import copy
+import pickle
+from decimal import Decimal
+
 from truthiness.truthtable import TruthTable, Variable, BoolDomain, EQ, IntDomain
+from truthiness.truthtable import EnumDomain, DecisionNode
 from truthiness.truthtable import GT, LT, GTE, LTE, EQ, NE, RangeCondition, sortConditions
+from truthiness.truthtable import findIntervalGaps
 
 from twisted.trial.unittest import TestCase
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 class TruthTests(TestCase):
     def test_evaluate(self):
@@ -10,6 +21,119 @@ class TruthTests(TestCase):
         tt.addCondition({'a': EQ(True), 'b': EQ(True)}, 'woo')
         self.assertEquals(tt.evaluate({'a': True, 'b': True}), 'woo')
 
+    def test_evaluateFirstMatch(self):
+        tt = TruthTable(a=BoolDomain(), c=IntDomain())
+        tt.addCondition({'a': EQ(True), 'c': LT(6)}, 'woo')
+        tt.addCondition({'a': EQ(False), 'c': RangeCondition(6, 10)}, 'werb')
+        tt.addCondition({'a': EQ(True), 'c': NE(8)}, 'werby')
+        self.assertEquals(tt.evaluate({'a': True, 'c': 3}), 'woo')
+        self.assertEquals(tt.evaluate({'a': False, 'c': 10}), 'werb')
+        self.assertEquals(tt.evaluate({'a': True, 'c': 9}), 'werby')
+        self.assertEquals(tt.evaluate({'a': True, 'c': 8}), None)
+
+    def test_evaluateNonLiteralValues(self):
+        """
+        Conditions may refer to values whose repr isn't a Python literal.
+        """
+        thing = object()
+        other = object()
+        tt = TruthTable(a=EnumDomain([thing, other]), c=IntDomain())
+        tt.addCondition({'a': EQ(thing), 'c': RangeCondition(0, float('inf'))},
+                        'woo')
+        tt.addCondition({'a': EQ(other), 'c': LT(float('inf'))}, 'werb')
+        self.assertEquals(tt.evaluate({'a': thing, 'c': 3}), 'woo')
+        self.assertEquals(tt.evaluate({'a': other, 'c': 3}), 'werb')
+        self.assertEquals(tt.evaluate({'a': thing, 'c': -1}), None)
+
+    def test_evaluateCompiled(self):
+        tt = TruthTable(a=BoolDomain(), b=BoolDomain(), c=IntDomain())
+        tt.addCondition({'a': EQ(True), 'b': EQ(True), 'c': LT(6)}, 'woo')
+        tt.addCondition({'a': EQ(False), 'b': EQ(True), 'c': EQ(7)}, 'werb')
+        tt.addCondition({'a': EQ(True), 'b': NE(False), 'c': NE(8)}, 'werby')
+        tt.addCondition({'a': NE(True), 'b': EQ(False), 'c': GT(0)}, 'wub')
+        inputs = [{'a': a, 'b': b, 'c': c}
+                  for a in (True, False) for b in (True, False)
+                  for c in (-1, 3, 7, 8, 9)]
+        expected = [tt.evaluate(values) for values in inputs]
+        tt.compile()
+        self.assertEquals([tt.evaluate(values) for values in inputs], expected)
+        tt.addCondition({'a': EQ(False), 'b': EQ(False), 'c': LTE(0)}, 'wib')
+        self.assertEquals(tt.evaluate({'a': False, 'b': False, 'c': -1}),
+                          'wib')
+
+    def test_compileUnhashable(self):
+        """
+        Equality conditions on unhashable values are checked by scanning, not
+        switched on.
+        """
+        tt = TruthTable(a=EnumDomain([]), b=BoolDomain())
+        tt.addCondition({'a': EQ([1, 2]), 'b': EQ(True)}, 'woo')
+        tt.addCondition({'a': EQ([3]), 'b': EQ(True)}, 'werb')
+        tt.addCondition({'a': EQ([1, 2]), 'b': EQ(False)}, 'werby')
+        tt.compile()
+        self.assertEquals(tt.evaluate({'a': [1, 2], 'b': True}), 'woo')
+        self.assertEquals(tt.evaluate({'a': [3], 'b': True}), 'werb')
+        self.assertEquals(tt.evaluate({'a': [1, 2], 'b': False}), 'werby')
+        self.assertEquals(tt.evaluate({'a': [3], 'b': False}), None)
+
+    def test_compileBounded(self):
+        """
+        Rows copied into several branches of the decision tree don't make it
+        grow exponentially with the number of columns.
+        """
+        names = 'abcdefgh'
+        tt = TruthTable(**dict((name, IntDomain()) for name in names))
+        for i in range(48):
+            values = dict((name, NE(i)) for name in names)
+            values[names[i % len(names)]] = EQ(i)
+            tt.addCondition(values, i)
+        tt.compile()
+
+        def leafSize(node):
+            if isinstance(node, DecisionNode):
+                return leafSize(node.default) + sum(
+                    leafSize(branch) for branch in node.branches.values())
+            return len(node)
+        self.assertTrue(leafSize(tt._tree) <= 2 * 48)
+        for i in range(48):
+            values = dict((name, 100) for name in names)
+            values[names[i % len(names)]] = i
+            self.assertEquals(tt.evaluate(values), i)
+
+    def test_evaluateBatch(self):
+        tt = TruthTable(a=BoolDomain(), c=IntDomain())
+        tt.addCondition({'a': EQ(True), 'c': LT(6)}, 'woo')
+        tt.addCondition({'a': EQ(False), 'c': RangeCondition(6, 10)}, 'werb')
+        tt.addCondition({'a': EQ(True), 'c': NE(8)}, 'werby')
+        results = tt.evaluateBatch({'a': numpy.array([True, False, True, True]),
+                                    'c': numpy.array([3, 10, 9, 8])})
+        self.assertEquals(list(results), ['woo', 'werb', 'werby', None])
+
+    def test_evaluateBatchSequenceResult(self):
+        tt = TruthTable(c=IntDomain())
+        tt.addCondition({'c': LT(6)}, ('x', 'y'))
+        results = tt.evaluateBatch({'c': numpy.array([1, 2, 3])})
+        self.assertEquals(list(results), [('x', 'y')] * 3)
+        results = tt.evaluateBatch({'c': numpy.array([1, 2])})
+        self.assertEquals(list(results), [('x', 'y')] * 2)
+
+    def test_evaluateBatchSequenceValue(self):
+        pair = (1, 2)
+        tt = TruthTable(a=EnumDomain([pair, (3, 4)]))
+        tt.addCondition({'a': EQ(pair)}, 'x')
+        for size in (2, 3):
+            values = numpy.empty(size, object)
+            for i in range(size):
+                values[i] = [pair, (3, 4)][i % 2]
+            expected = [tt.evaluate({'a': value}) for value in values]
+            self.assertEquals(expected[:2], ['x', None])
+            self.assertEquals(list(tt.evaluateBatch({'a': values})), expected)
+
+    if numpy is None:
+        test_evaluateBatch.skip = "numpy is not installed"
+        test_evaluateBatchSequenceResult.skip = "numpy is not installed"
+        test_evaluateBatchSequenceValue.skip = "numpy is not installed"
+
     def test_intGapsGT(self):
         tt = TruthTable(a=IntDomain())
         tt.addCondition({'a': GT(5)}, 'woo')
@@ -61,6 +185,70 @@ class TruthTests(TestCase):
         tt.addCondition({'a': GT(0)}, 'woobar')
         self.assertEquals(tt.findGaps(), [{'a': [EQ(0)]}])
 
+    def test_intGapsOverlapping(self):
+        tt = TruthTable(a=IntDomain())
+        tt.addCondition({'a': EQ(0)}, 'woo')
+        tt.addCondition({'a': LT(5)}, 'woobar')
+        tt.addCondition({'a': RangeCondition(3, 8)}, 'woobaz')
+        tt.addCondition({'a': RangeCondition(4, 6)}, 'wooquux')
+        tt.addCondition({'a': GT(10)}, 'woofoo')
+        self.assertEquals(tt.findGaps(), [{'a': [RangeCondition(9, 10)]}])
+
+    def test_intGapsOverlappingEnd(self):
+        tt = TruthTable(a=IntDomain())
+        tt.addCondition({'a': LT(0)}, 'woo')
+        tt.addCondition({'a': RangeCondition(-5, 10)}, 'woobar')
+        tt.addCondition({'a': EQ(3)}, 'woobaz')
+        self.assertEquals(tt.findGaps(), [{'a': [GT(10)]}])
+
+    def test_intGapsTiedBounds(self):
+        """
+        When conditions tie on the bound a gap is derived from, the gap
+        doesn't depend on their order.
+        """
+        for conditions, expected in [([GT(4), EQ(5)], [LTE(4)]),
+                                     ([EQ(5), LT(6)], [GTE(6)])]:
+            self.assertEquals(IntDomain().checkCoverage(conditions), expected)
+            self.assertEquals(IntDomain().checkCoverage(conditions[::-1]),
+                              expected)
+
+    def test_findIntervalGaps(self):
+        self.assertEquals(findIntervalGaps(-1, 20, [0, 3, 4, 12, 15],
+                                           [2, 8, 5, 12, 30]),
+                          [(9, 11), (13, 14)])
+        self.assertEquals(findIntervalGaps(-1, 1, [], []), [(0, 0)])
+        self.assertEquals(findIntervalGaps(4, 4, [], []), [])
+
+    def test_coverageCached(self):
+        domain = IntDomain()
+        gaps = domain.checkCoverage([LT(0), GT(10)])
+        gaps.append(EQ(5))
+        self.assertEquals(domain.checkCoverage([GT(10), LT(0), GT(10)]),
+                          [RangeCondition(0, 10)])
+
+    def test_coverageCacheOrder(self):
+        """
+        The cached result for a set of conditions is the same as the
+        uncached one, whichever order the conditions were first given in.
+        """
+        for conditions in [[GT(4), EQ(5)], [EQ(5), LT(6)], [NE(3), EQ(3)],
+                           [LT(0), RangeCondition(0, 4), GT(2)]]:
+            domain = IntDomain()
+            domain.checkCoverage(conditions)
+            self.assertEquals(domain.checkCoverage(conditions[::-1]),
+                              IntDomain().checkCoverage(conditions[::-1]))
+            domain = IntDomain()
+            domain.checkCoverage(conditions[::-1])
+            self.assertEquals(domain.checkCoverage(conditions),
+                              IntDomain().checkCoverage(conditions))
+
+    def test_coverageCacheBounded(self):
+        domain = IntDomain()
+        domain.coverageCacheSize = 3
+        for i in range(10):
+            self.assertEquals(domain.checkCoverage([LT(i), GT(i)]), [EQ(i)])
+            self.assertTrue(len(domain._coverageCache) <= 3)
+
     def test_sortConditions(self):
         conditions = [EQ(5), GT(7), LT(3)]
         self.assertEquals(sortConditions(conditions),
@@ -70,6 +258,12 @@ class TruthTests(TestCase):
         conditions = [EQ(5), LT(3)]
         self.assertEquals(sortConditions(conditions), [conditions[1], conditions[0]])
 
+    def test_sortConditionsSameValue(self):
+        conditions = [NE(5), GT(5), GTE(5), RangeCondition(5, 6), EQ(5),
+                      LTE(5), LT(5)]
+        self.assertEquals(sortConditions(conditions),
+                          list(reversed(conditions)))
+
     def test_conditionEquality(self):
         self.assertEquals(LT(5), LT(5))
         self.assertNotEquals(LT(3), LT(5))
@@ -81,6 +275,41 @@ class TruthTests(TestCase):
         self.assertEquals([RangeCondition(5, 8)], [RangeCondition(5, 8)])
         self.assertEquals(set([RangeCondition(5, 8)]), set([RangeCondition(5, 8)]))
 
+    def test_matches(self):
+        self.assertEquals([LT(5).matches(x) for x in (4, 5, 6)],
+                          [True, False, False])
+        self.assertEquals([LTE(5).matches(x) for x in (4, 5, 6)],
+                          [True, True, False])
+        self.assertEquals([EQ(5).matches(x) for x in (4, 5, 6)],
+                          [False, True, False])
+        self.assertEquals([NE(5).matches(x) for x in (4, 5, 6)],
+                          [True, False, True])
+        self.assertEquals([GTE(5).matches(x) for x in (4, 5, 6)],
+                          [False, True, True])
+        self.assertEquals([GT(5).matches(x) for x in (4, 5, 6)],
+                          [False, False, True])
+        self.assertEquals([RangeCondition(5, 6).matches(x) for x in (4, 5, 7)],
+                          [False, True, False])
+
+    def test_conditionKeepsValue(self):
+        """
+        A condition keeps exactly the value it was made with, even while an
+        equal condition with an equal value exists.
+        """
+        first = EQ(Decimal('1.0'))
+        self.assertEquals(repr(EQ(Decimal('1.00')).value), "Decimal('1.00')")
+        self.assertEquals(repr(first.value), "Decimal('1.0')")
+        self.assertEquals(repr(EQ((1.0, 1))), "EqualityCondition((1.0, 1))")
+
+    def test_conditionCopyAndPickle(self):
+        for condition in [LT(5), LTE(5), EQ(5), NE(5), GTE(5), GT(5),
+                          RangeCondition(3, 5)]:
+            self.assertEquals(copy.copy(condition), condition)
+            self.assertEquals(copy.deepcopy(condition), condition)
+            for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+                self.assertEquals(
+                    pickle.loads(pickle.dumps(condition, protocol)), condition)
+
     def test_highest(self):
         self.assertEquals(LT(5).highest(), 4)
         self.assertEquals(LTE(5).highest(), 5)
@@ -102,6 +331,20 @@ class TruthTests(TestCase):
         tt.addCondition({'a': EQ(False)}, 'woo')
         self.assertEquals(tt.findGaps(), [{'a': [EQ(True)]}])
 
+    def test_boolGapsEmpty(self):
+        self.assertEquals(BoolDomain().checkCoverage([]),
+                          [EQ(False), EQ(True)])
+        self.assertEquals(BoolDomain().checkCoverage([EQ(True), EQ(False)]),
+                          [])
+
+    def test_boolGapsOtherValues(self):
+        """
+        Values which aren't equal to True or False don't cover either.
+        """
+        self.assertEquals(BoolDomain().checkCoverage([EQ('yes'), EQ(None)]),
+                          [EQ(False), EQ(True)])
+        self.assertEquals(BoolDomain().checkCoverage([EQ(1), EQ(0)]), [])
+
     def test_multiColumnGaps(self):
         tt = TruthTable(a=BoolDomain(), b=BoolDomain())
         tt.addCondition({'a': EQ(True), 'b': EQ(True)}, 'woo')
@@ -1,11 +1,36 @@
-from operator import eq, gt, ge, lt, le, ne
+from operator import eq, gt, ge, lt, le, ne, attrgetter, itemgetter
 
 
 class Domain(object):
+    # The most results checkCoverage keeps cached before starting over.
+    coverageCacheSize = 4096
+
+    def __init__(self):
+        self._coverageCache = {}
+
     def checkCoverage(self, conditions):
         """
         Return a list of "gaps", or conditions that need to be met in order
         to complete the domain.
+
+        The result only depends on which distinct conditions are given, not
+        on their order or repetition, so it is cached per domain on that set
+        of conditions. The cache relies on the conditions' equality, so for
+        example C{EQ(1)} and C{EQ(1.0)} share an entry.
+        """
+        key = frozenset(conditions)
+        gaps = self._coverageCache.get(key)
+        if gaps is None:
+            gaps = self._checkCoverage(conditions)
+            if len(self._coverageCache) >= self.coverageCacheSize:
+                self._coverageCache.clear()
+            self._coverageCache[key] = gaps
+        return list(gaps)
+
+    def _checkCoverage(self, conditions):
+        """
+        Compute the result of L{checkCoverage}, without caching. This must
+        give the same result for any ordering of C{conditions}.
         """
         raise NotImplementedError()
 
@@ -21,9 +46,10 @@ class EnumDomain(Domain):
     """
 
     def __init__(self, values):
+        Domain.__init__(self)
         self.values = set(values)
 
-    def checkCoverage(self, args):
+    def _checkCoverage(self, args):
         # This check should probably be done at addCondition time.
         for arg in args:
             if not isinstance(arg, EqualityCondition):
@@ -36,71 +62,125 @@ class BoolDomain(EnumDomain):
     def __init__(self):
         EnumDomain.__init__(self, [True, False])
 
+    def _checkCoverage(self, args):
+        # Track which of False (bit 0) and True (bit 1) are covered in a
+        # bitmask, instead of building sets like EnumDomain does.
+        covered = 0
+        for arg in args:
+            if not isinstance(arg, EqualityCondition):
+                raise UnsupportedCondition(BoolDomain, type(arg))
+            # Other values cover neither, just as in EnumDomain.
+            if arg.value == True:
+                covered |= 2
+            elif arg.value == False:
+                covered |= 1
+        gaps = []
+        if not covered & 1:
+            gaps.append(EqualityCondition(False))
+        if not covered & 2:
+            gaps.append(EqualityCondition(True))
+        return gaps
+
+
+_sortKey = attrgetter('sort_key', 'sort_order')
+
 
 def sortConditions(conds):
-    real_conds = []
-    for cond in conds:
-        # Since InequalityCondition covers a disjoint set, it can't be
-        # ordered. So replace it with two contiguous sets.
-        if isinstance(cond, InequalityCondition):
-            real_conds.append(LessThanCondition(cond.value))
-            real_conds.append(GreaterThanCondition(cond.value))
-        else:
-            real_conds.append(cond)
+    """
+    Sort conditions by the value they refer to, breaking ties by the kind of
+    condition (see C{sort_order}).
+    """
+    return sorted(conds, key=_sortKey)
 
-    return sorted(real_conds, key=lambda x: x.sort_key)
+
+def findIntervalGaps(covered, end, lows, highs):
+    """
+    Find the integers between C{covered} and C{end} (exclusive) which aren't
+    in any of a sequence of intervals. The intervals may overlap.
+
+    This only deals in ints, with no None or other sentinels, so that it can
+    be swapped for a compiled implementation.
+
+    @param lows: The lowest integer in each interval, sorted.
+    @param highs: The highest integer in each interval.
+    @return: A list of C{(low, high)} pairs, one for each gap.
+    """
+    gaps = []
+    for i in range(len(lows)):
+        low = lows[i]
+        if low >= end:
+            break
+        if low > covered + 1:
+            gaps.append((covered + 1, low - 1))
+        if highs[i] > covered:
+            covered = highs[i]
+    if covered + 1 < end:
+        gaps.append((covered + 1, end - 1))
+    return gaps
 
 
 class IntDomain(Domain):
     """
     The integer domain. Supports <, <=, =, ranges, >=, and >.
     """
-    def checkCoverage(self, args):
+    def _checkCoverage(self, args):
         """
         The basic strategy here is
         1. if there is no </<=, then add one.
         2. If there is no >/>=, then add one.
-        3. Fill in any gaps in the middle with ranges.
+        3. Merge the (possibly overlapping) conditions and fill in any gaps
+           between them with ranges.
         """
-        
-        conditions = sortConditions(args)
+
+        # Each condition's bounds are looked up exactly once; everything
+        # below works on these plain ints.
+        intervals = []
+        for condition in args:
+            if isinstance(condition, InequalityCondition):
+                # Since InequalityCondition covers a disjoint set, it's
+                # treated as the two contiguous sets on either side of it.
+                intervals.append((None, condition.value - 1, condition))
+                intervals.append((condition.value + 1, None, condition))
+            else:
+                intervals.append((condition.lowest(), condition.highest(),
+                                  condition))
+        unbounded_below = [x for x in intervals if x[0] is None]
+        unbounded_above = [x for x in intervals if x[1] is None]
+        bounded = sorted([x for x in intervals
+                          if x[0] is not None and x[1] is not None],
+                         key=itemgetter(0))
         gaps = []
         pre_gap = None
         post_gap = None
 
+        # The conditions at either end know their "nice" inverse, where
+        # "nice" means "referring to the same number". So, the inverse of
+        # > X is <= X, instead of < X+1. When several conditions share the
+        # bound, ties are broken by the sort order of the conditions
+        # themselves, so that the result doesn't depend on the order of args.
+        if unbounded_below:
+            covered = max(high for low, high, condition in unbounded_below)
+        else:
+            lowest, _, lowest_condition = min(
+                intervals, key=lambda x: (x[0], _sortKey(x[2])))
+            pre_gap = lowest_condition.leftGap()
+            covered = lowest - 1
 
-        # We introspect the condition to determine what the "nice" inverse
-        # would be, where "nice" means "referring to the same number". So,
-        # the inverse of > X is <= X, instead of < X+1.
-        if conditions[0].lowest() != None:
-            if isinstance(conditions[0], GreaterThanCondition):
-                pre_gap = LessThanOrEqualToCondition(conditions[0].lowest() - 1)
-            else:
-                pre_gap = LessThanCondition(conditions[0].lowest())
-
-        if conditions[-1].highest() != None:
-            if isinstance(conditions[-1], LessThanCondition):
-                post_gap = GreaterThanOrEqualToCondition(conditions[-1].highest() + 1)
+        if unbounded_above:
+            end = min(low for low, high, condition in unbounded_above)
+        else:
+            _, highest, highest_condition = max(
+                intervals, key=lambda x: (x[1], _sortKey(x[2])))
+            post_gap = highest_condition.rightGap()
+            end = highest + 1
+
+        lows = [low for low, high, condition in bounded]
+        highs = [high for low, high, condition in bounded]
+        for low, high in findIntervalGaps(covered, end, lows, highs):
+            if low == high:
+                gaps.append(EqualityCondition(low))
             else:
-                post_gap = GreaterThanCondition(conditions[-1].highest())
-
-        hypothetical_conditions = conditions[:]
-        if pre_gap is not None:
-            hypothetical_conditions.insert(0, pre_gap)
-        if post_gap is not None:
-            hypothetical_conditions.append(post_gap)
-        highest_covered = hypothetical_conditions[0].highest()
-        assert highest_covered != None, hypothetical_conditions[0]
-
-        for condition in hypothetical_conditions[1:]:
-            if highest_covered is None:
-                break
-            if condition.lowest() - 1 != highest_covered:
-                if highest_covered + 1 == condition.lowest() - 1:
-                    gaps.append(EqualityCondition(highest_covered + 1))
-                else:
-                    gaps.append(RangeCondition(highest_covered + 1, condition.lowest() - 1))
-            highest_covered = condition.highest()
+                gaps.append(RangeCondition(low, high))
 
         if pre_gap is not None:
             gaps.insert(0, pre_gap)
@@ -110,54 +190,146 @@ class IntDomain(Domain):
         return gaps
 
 
+def numpyScalar(value):
+    """
+    Return C{value} in a form numpy treats as a single element, rather than
+    spreading it across an array if it's a sequence.
+    """
+    import numpy
+    try:
+        if numpy.ndim(value) == 0:
+            return value
+    except ValueError:
+        pass
+    scalar = numpy.empty((), object)
+    scalar[()] = value
+    return scalar
+
+
 class SimpleOperatorCondition(object):
+    """
+    @cvar sort_order: Breaks ties between conditions with the same
+        C{sort_key}.
+    @cvar selectivity: A rough rank of how few values the condition matches,
+        lowest first. Used to order checks in compiled predicates.
+    """
+    __slots__ = ('value',)
+
     def __init__(self, value):
         self.value = value
-        self.sort_key = value
+
+    @property
+    def sort_key(self):
+        return self.value
 
     def matches(self, other):
+        """
+        Return whether C{other} matches this condition. Subclasses override
+        this with the comparison spelled out directly, which is cheaper than
+        going through C{operator}.
+        """
         return self.operator(other, self.value)
 
+    def leftGap(self):
+        """
+        Return the condition covering everything below this one. Only valid
+        if C{lowest} is not None.
+        """
+        return LessThanCondition(self.lowest())
+
+    def rightGap(self):
+        """
+        Return the condition covering everything above this one. Only valid
+        if C{highest} is not None.
+        """
+        return GreaterThanCondition(self.highest())
+
     def format(self):
         return "%s %r" % (self.formatted_operator, self.value)
 
+    def mask(self, array):
+        """
+        Return a boolean array of which elements of C{array} match this
+        condition.
+        """
+        return self.operator(array, numpyScalar(self.value))
+
+    def code(self, var, name):
+        """
+        Return a Python expression testing the value named by C{var}
+        against this condition, along with a mapping of the names the
+        expression uses for this condition's own values (all starting with
+        C{name}) to those values.
+        """
+        return ("(%s %s %s)" % (var, self.formatted_operator, name),
+                {name: self.value})
+
     def __eq__(self, other):
-        return type(self) == type(other) and self.value == other.value and self.sort_key == other.sort_key
+        return self is other or (type(self) == type(other) and self.value == other.value)
 
     def __repr__(self):
         return "%s(%r)" % (type(self).__name__, self.value)
 
+    def __reduce__(self):
+        # Needed to pickle instances with protocol 0, since they have
+        # __slots__.
+        return type(self), (self.value,)
+
     def __hash__(self):
-        return hash((type(self), self.value, self.sort_key))
+        return hash((type(self), self.value))
 
 
 class GreaterThanCondition(SimpleOperatorCondition):
+    __slots__ = ()
+    sort_order = 5
+    selectivity = 2
     operator = gt
     formatted_operator = ">"
+    def matches(self, other):
+        return other > self.value
+
     def lowest(self):
         return self.value + 1
 
     def highest(self):
         return None
 
+    def leftGap(self):
+        return LessThanOrEqualToCondition(self.value)
+
 GT = GreaterThanCondition
 
 
 class LessThanCondition(SimpleOperatorCondition):
+    __slots__ = ()
+    sort_order = 0
+    selectivity = 2
     operator = lt
     formatted_operator = "<"
+    def matches(self, other):
+        return other < self.value
+
     def lowest(self):
         return None
 
     def highest(self):
         return self.value - 1
 
+    def rightGap(self):
+        return GreaterThanOrEqualToCondition(self.value)
+
 LT = LessThanCondition
 
 
 class GreaterThanOrEqualToCondition(SimpleOperatorCondition):
+    __slots__ = ()
+    sort_order = 4
+    selectivity = 2
     operator = ge
     formatted_operator = ">="
+    def matches(self, other):
+        return other >= self.value
+
     def lowest(self):
         return self.value
 
@@ -168,8 +340,14 @@ GTE = GreaterThanOrEqualToCondition
 
 
 class LessThanOrEqualToCondition(SimpleOperatorCondition):
+    __slots__ = ()
+    sort_order = 1
+    selectivity = 2
     operator = le
     formatted_operator = "<="
+    def matches(self, other):
+        return other <= self.value
+
     def lowest(self):
         return None
 
@@ -180,11 +358,18 @@ LTE = LessThanOrEqualToCondition
 
 
 class RangeCondition(object):
+    __slots__ = ('min', 'max')
+    sort_order = 3
+    selectivity = 1
+
     def __init__(self, min, max):
         assert min <= max, "%r <= %r" % (min, max)
         self.min = min
         self.max = max
-        self.sort_key = min
+
+    @property
+    def sort_key(self):
+        return self.min
 
     def lowest(self):
         return self.min
@@ -192,26 +377,49 @@ class RangeCondition(object):
     def highest(self):
         return self.max
 
+    def leftGap(self):
+        return LessThanCondition(self.min)
+
+    def rightGap(self):
+        return GreaterThanCondition(self.max)
+
     def matches(self, other):
         return other >= self.min and other <= self.max
 
     def format(self):
         return "%r - %r" % (self.min, self.max)
 
+    def mask(self, array):
+        return ((array >= numpyScalar(self.min))
+                & (array <= numpyScalar(self.max)))
+
+    def code(self, var, name):
+        return ("(%s_min <= %s <= %s_max)" % (name, var, name),
+                {name + "_min": self.min, name + "_max": self.max})
+
     def __eq__(self, other):
-        return type(self) == type(other) and self.min == other.min and self.max == other.max and self.sort_key == other.sort_key
+        return self is other or (type(self) == type(other) and self.min == other.min and self.max == other.max)
 
     def __hash__(self):
-        return hash((type(self), self.min, self.max, self.sort_key))
+        return hash((type(self), self.min, self.max))
 
     def __repr__(self):
         return "RangeCondition(%r, %r)" % (self.min, self.max)
 
+    def __reduce__(self):
+        return type(self), (self.min, self.max)
+
 
 class EqualityCondition(SimpleOperatorCondition):
+    __slots__ = ()
+    sort_order = 2
+    selectivity = 0
     operator = eq
     formatted_operator = "=="
 
+    def matches(self, other):
+        return other == self.value
+
     def highest(self):
         return self.value
 
@@ -222,9 +430,15 @@ EQ = EqualityCondition
 
 
 class InequalityCondition(SimpleOperatorCondition):
+    __slots__ = ()
+    sort_order = 6
+    selectivity = 3
     operator = ne
     formatted_operator = "!="
 
+    def matches(self, other):
+        return other != self.value
+
     def highest(self):
         return None
 
@@ -243,21 +457,162 @@ class Variable(object):
         return "Variable(%r, %r)" % (self.name, self.domain)
 
 
+def compilePredicate(conditions):
+    """
+    Compile a mapping of variable names to conditions into a single function
+    which takes a mapping of variable names to values and returns whether
+    all of the conditions match.
+    """
+    # Test the conditions least likely to match first, so that rows which
+    # don't match are rejected as early as possible.
+    ordered = sorted(conditions.iteritems(), key=lambda x: x[1].selectivity)
+    tests = []
+    constants = {}
+    for i, (name, condition) in enumerate(ordered):
+        # The conditions' values are passed in by name rather than written
+        # into the source, since not every value has a repr that evaluates
+        # back to it. Binding them as default arguments makes them locals.
+        test, names = condition.code("v[%r]" % (name,), "_c%d" % (i,))
+        tests.append(test)
+        constants.update(names)
+    arguments = "".join(", %s=%s" % (x, x) for x in sorted(constants))
+    source = "lambda v%s: %s" % (arguments, " and ".join(tests) or "True")
+    return eval(source, constants)
+
+
 class Row(object):
+   """
+   A row of a L{TruthTable}.
 
-   def __init__(self, conditions, result):
+   @ivar conditions: A tuple of conditions, one for each column of the table,
+       in the same order as the table's columns.
+   @ivar predicate: A function taking a mapping of variable names to values
+       and returning whether they match all of C{conditions}.
+   """
+
+   def __init__(self, conditions, result, predicate):
        self.conditions = conditions
        self.result = result
+       self.predicate = predicate
+
+
+class DecisionNode(object):
+   """
+   A node of a decision tree built by L{buildDecisionTree}.
+
+   @ivar name: The name of the variable this node switches on.
+   @ivar branches: A mapping of values of that variable to subtrees.
+   @ivar default: The subtree for values not in C{branches}.
+   """
+
+   def __init__(self, name, branches, default):
+       self.name = name
+       self.branches = branches
+       self.default = default
+
+
+def isSwitchable(condition):
+    """
+    Return whether a decision tree can switch on C{condition}: that is,
+    whether it's an L{EqualityCondition} on a hashable value.
+    """
+    if not isinstance(condition, EqualityCondition):
+        return False
+    try:
+        hash(condition.value)
+    except TypeError:
+        return False
+    return True
+
+
+def buildDecisionTree(rows, columns, budget):
+    """
+    Build a decision tree which narrows C{rows} down by the values of
+    variables compared with L{EqualityCondition}s.
+
+    Each node switches on the column where the most rows have an equality
+    condition (see L{isSwitchable}). Rows with any other kind of condition
+    in that column are kept in every branch. Leaves are lists of rows, still in table order, which
+    must be checked in turn.
+
+    Since rows can be copied into many branches, the tree could grow
+    exponentially with the number of columns. To prevent that, the leaves
+    together never hold more than C{budget} rows; a split which would exceed
+    it isn't made, and the rows are left to be scanned linearly instead.
+
+    @param rows: A list of L{Row}s.
+    @param columns: A list of C{(index, name)} pairs of the columns which
+        haven't been switched on yet.
+    @param budget: The most rows the leaves of the tree may hold in total.
+        Must be at least C{len(rows)}.
+    """
+    best = None
+    best_count = 0
+    for index, name in columns:
+        count = len([row for row in rows
+                     if isSwitchable(row.conditions[index])])
+        if count > best_count:
+            best = index, name
+            best_count = count
+    if best is None:
+        return rows
+
+    index, name = best
+    branches = dict((row.conditions[index].value, []) for row in rows
+                    if isSwitchable(row.conditions[index]))
+    default = []
+    for row in rows:
+        condition = row.conditions[index]
+        if isSwitchable(condition):
+            branches[condition.value].append(row)
+        else:
+            default.append(row)
+            for branch in branches.itervalues():
+                branch.append(row)
+
+    total = len(default) + sum(len(branch) for branch in branches.itervalues())
+    if total > budget:
+        return rows
+
+    # Share the budget out in proportion to the size of each subtree, so
+    # that each gets at least as much as it has rows.
+    remaining = [column for column in columns if column != best]
+    for value, branch in branches.items():
+        branches[value] = buildDecisionTree(
+            branch, remaining, budget * len(branch) // total)
+    default = buildDecisionTree(default, remaining,
+                                budget * len(default) // total)
+    return DecisionNode(name, branches, default)
 
 
 class TruthTable(object):
     def __init__(self, **columns):
         self.columns = [Variable(k, v) for k, v in columns.iteritems()]
         self._table = []
+        # The same conditions as in self._table, but kept column by column for
+        # findGaps.
+        self._columnConditions = dict((column.name, [])
+                                      for column in self.columns)
+        self._tree = None
 
     def addCondition(self, values, result):
         assert set(values.keys()) == set([x.name for x in self.columns])
-        self._table.append(Row(values, result))
+        conditions = tuple(values[column.name] for column in self.columns)
+        self._table.append(Row(conditions, result, compilePredicate(values)))
+        for name, condition in values.iteritems():
+            self._columnConditions[name].append(condition)
+        self._tree = None
+
+    def compile(self):
+        """
+        Build a decision tree over the table's equality conditions, which
+        L{evaluate} will use to skip rows that can't match, until the next
+        call to L{addCondition}. The tree's leaves hold at most twice as many
+        rows as the table.
+        """
+        self._tree = buildDecisionTree(
+            self._table, list(enumerate(x.name for x in self.columns)),
+            len(self._table) * 2)
 
     def evaluate(self, values):
         # Optimize this. Here's an idea.
@@ -273,13 +628,41 @@ class TruthTable(object):
         # But that's still a pretty naive approach. It ignores cases where
         # given inputs A (cost 0), B (cost 10) and C (cost 100), C is *always*
         # necessary, but B is not. Or does it? I need to trace this out.
-        for row in self._table:
-            for key in row.conditions.keys():
-                if not row.conditions[key].matches(values[key]):
-                    break
-            else:
+        node = self._tree
+        try:
+            while isinstance(node, DecisionNode):
+                node = node.branches.get(values[node.name], node.default)
+        except TypeError:
+            # An unhashable value can't be looked up in the tree.
+            node = None
+        rows = self._table if node is None else node
+        for row in rows:
+            if row.predicate(values):
                 return row.result
 
+    def evaluateBatch(self, columns):
+        """
+        Evaluate many sets of values at once.
+
+        @param columns: A mapping of variable names to equal-length numpy
+            arrays, where the values at each index form one set of values.
+        @return: A numpy object array holding the result for each index, or
+            None where no row matched.
+        """
+        import numpy
+        size = len(columns.itervalues().next())
+        remaining = numpy.ones(size, bool)
+        results = numpy.empty(size, object)
+        for row in self._table:
+            matched = remaining.copy()
+            for column, condition in zip(self.columns, row.conditions):
+                matched &= condition.mask(columns[column.name])
+            results[matched] = numpyScalar(row.result)
+            remaining &= ~matched
+            if not remaining.any():
+                break
+        return results
+
     def format(self):
         s = ''
         for column in self.columns:
@@ -287,31 +670,19 @@ class TruthTable(object):
         s += '%10s\n' % ('result',)
         s += '-' * 11 * (len(self.columns) + 1) + '\n'
         for row in self._table:
-            for column in self.columns:
-                s += '%10s |' % (row.conditions[column.name].format(),)
+            for condition in row.conditions:
+                s += '%10s |' % (condition.format(),)
             s += '%10r\n' % (row.result,)
         return s
 
     def findGaps(self):
         gaps = []
         for column in self.columns:
-            this_column_values = [x.conditions[column.name] for x in self._table]
+            this_column_values = self._columnConditions[column.name]
             this_column_gaps = column.domain.checkCoverage(this_column_values)
-            for condition in this_column_values + this_column_gaps:
-                combinations = [row.conditions for row in self._table if row.conditions[column.name] == condition]
-                for other_column in self.columns:
-                    if other_column == column:
-                        continue
-                    other_column_values = [row[other_column.name] for row in  combinations]
-                    print "all values of %s where %s is %s: %s" % (other_column.name, column.name, condition, other_column_values)
-                    other_column_gaps = other_column.domain.checkCoverage(other_column_values)
-                    print "having gaps", other_column_gaps
-#                for other_column in self.columns:
-#                    if other_column == column:
-#                        continue
-#                    other_column_values = [row for row in self._table if row.conditions[column.name] == condition]
-#                    pass
-                #print "combinations with", column.name, condition, combinations
+            # XXX Check the other columns' coverage for each of this column's
+            # conditions and gaps, to find gaps in combinations of columns
+            # (see test_multiColumnGaps).
             gaps.append({column.name: this_column_gaps})
         return gaps
 